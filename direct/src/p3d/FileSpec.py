@@ -13,10 +13,24 @@ class FileSpec:
     def __init__(self):
         self.actualFile = None
         self.filename = None
+        self.basename = None
         self.size = 0
         self.timestamp = 0
         self.hash = None
 
+    def clone(self):
+        """ Returns a new FileSpec with the same file information as
+        this one. """
+
+        fileSpec = FileSpec()
+        fileSpec.actualFile = self.actualFile
+        fileSpec.filename = self.filename
+        fileSpec.basename = self.basename
+        fileSpec.size = self.size
+        fileSpec.timestamp = self.timestamp
+        fileSpec.hash = self.hash
+        return fileSpec
+
     def fromFile(self, packageDir, filename, pathname = None, st = None):
         """ Reads the file information from the indicated file.  If st
         is supplied, it is the result of os.stat on the filename. """
@@ -3,7 +3,102 @@ __all__ = ["PatchMaker"]
 from direct.p3d.FileSpec import FileSpec
 from direct.p3d.SeqValue import SeqValue
 from panda3d.core import *
-import copy
+from collections import deque
+
+try:
+    from sys import intern
+except ImportError:
+    # On Python 2, intern() is a builtin.
+    pass
+
+def iterChildElements(xelement):
+    """ Yields each of the child elements of the indicated XML
+    element in turn. """
+
+    xchild = xelement.FirstChildElement()
+    while xchild:
+        yield xchild
+        xchild = xchild.NextSiblingElement()
+
+def internAttribute(xelement, name):
+    """ Returns the named attribute of the indicated XML element,
+    interned so that equal values share a single string object, or
+    None if the attribute is not set. """
+
+    value = xelement.Attribute(name)
+    if value:
+        value = intern(value)
+    return value
+
+# The C++ Patchfile object used by buildPatchJob() to build patches in
+# a worker process, when it isn't given one.  The worker keeps it
+# until the pool shuts down.
+_workerPatchfile = None
+
+def buildPatchFile(origFilename, newFilename, patchFilename,
+                   compressionLevel, patchfile = None):
+    """ Creates a patch file from origFilename to newFilename,
+    compressing it at the indicated zlib compression level as it is
+    built, and storing the compressed result in patchFilename.  The
+    uncompressed patch is never written to disk.  If patchfile is
+    given, it is the C++ Patchfile object with which to build the
+    patch; reusing one saves reallocating its hash table for every
+    build.  Returns true on success, false on failure. """
+
+    patchFilename = Filename.binaryFilename(patchFilename)
+    patchFilename.unlink()
+
+    vfs = VirtualFileSystem.getGlobalPtr()
+    stream = vfs.openWriteFile(patchFilename, False, True)
+    if not stream:
+        print("Couldn't write %s" % (patchFilename))
+        return False
+
+    p = patchfile
+    if p is None:
+        p = Patchfile()  # The C++ class
+
+    compressStream = OCompressStream(stream, False, compressionLevel)
+    try:
+        result = p.build(origFilename, newFilename, compressStream)
+        compressStream.close()
+        if compressStream.fail() or stream.fail():
+            # The disk filled up, or the compressor failed; whatever
+            # made it to disk is truncated.
+            print("Couldn't write %s" % (patchFilename))
+            result = False
+    finally:
+        compressStream.close()
+        vfs.closeWriteFile(stream)
+
+    if not result:
+        # Unable to build a patch for some reason.
+        patchFilename.unlink()
+    return result
+
+def buildPatchJob(job, patchfile = None):
+    """ Builds a single compressed patch, as described by the job
+    tuple (origFilename, newFilename, pathname, compressionLevel)
+    returned by PatchMaker.makePatchJob().  The compressed patch is
+    written to pathname.pz.  This may be run in a worker process, so
+    the filenames are passed as os-specific strings.  patchfile is the
+    C++ Patchfile object to build with; in a worker process, where it
+    is omitted, one is created on the first job and reused for the
+    rest.  Returns true on success, false on failure. """
+
+    global _workerPatchfile
+    if patchfile is None:
+        if _workerPatchfile is None:
+            _workerPatchfile = Patchfile()  # The C++ class
+        patchfile = _workerPatchfile
+
+    origFilename, newFilename, pathname, compressionLevel = job
+    origFilename = Filename.fromOsSpecific(origFilename)
+    newFilename = Filename.fromOsSpecific(newFilename)
+    compressedPathname = Filename.fromOsSpecific(pathname + '.pz')
+
+    return buildPatchFile(origFilename, newFilename, compressedPathname,
+                          compressionLevel, patchfile)
 
 class PatchMaker:
     """ This class will operate on an existing package install
@@ -11,12 +106,17 @@ class PatchMaker:
     between versions as needed.  It is also used at runtime, to apply
     the downloaded patches. """
 
-    class PackageVersion:
+    class PackageVersion(object):
         """ A specific patch version of a package.  This is not just
         the package's "version" string; it also corresponds to the
         particular patch version, which increments independently of
         the "version". """
 
+        __slots__ = ('packageName', 'platform', 'version', 'hostUrl',
+                     'file', 'printName', 'packageCurrent',
+                     'packageBase', 'packageTop', 'fromPatches',
+                     'toPatches', 'nextIndex', 'tempFile')
+
         def __init__(self, packageName, platform, version, hostUrl, file):
             self.packageName = packageName
             self.platform = platform
@@ -37,6 +137,11 @@ class PatchMaker:
             # A list of patchfiles that can start from this version.
             self.toPatches = []
 
+            # A dictionary of (packageName, platform, version, hostUrl)
+            # to the PackageVersion reached by the first of toPatches
+            # for that package, built on demand by getNext().
+            self.nextIndex = None
+
             # A temporary file for re-creating the archive file for
             # this version.
             self.tempFile = None
@@ -44,8 +149,9 @@ class PatchMaker:
         def cleanup(self):
             if self.tempFile:
                 self.tempFile.unlink()
+                self.tempFile = None
 
-        def getPatchChain(self, startPv, alreadyVisited = []):
+        def getPatchChain(self, startPv):
             """ Returns a list of patches that, when applied in
             sequence to the indicated PackageVersion object, will
             produce this PackageVersion object.  Returns None if no
@@ -55,29 +161,39 @@ class PatchMaker:
                 # We're already here.  A zero-length patch chain is
                 # therefore the answer.
                 return []
-            if self in alreadyVisited:
-                # We've already been here; this is a loop.  Avoid
-                # infinite recursion.
-                return None
 
-            alreadyVisited = alreadyVisited[:]
-            alreadyVisited.append(self)
-
-            bestPatchChain = None
-            for patchfile in self.fromPatches:
-                fromPv = patchfile.fromPv
-                patchChain = fromPv.getPatchChain(startPv, alreadyVisited)
-                if patchChain is not None:
-                    # There's a path through this patchfile.
-                    patchChain = patchChain + [patchfile]
-                    if bestPatchChain is None or len(patchChain) < len(bestPatchChain):
-                        bestPatchChain = patchChain
-
-            # Return the shortest path found, or None if there were no
-            # paths found.
-            return bestPatchChain
+            # This is a breadth-first search backwards from this
+            # version along fromPatches, so the first time we reach
+            # startPv we have found the shortest chain, and no version
+            # is ever visited twice.  The pred dictionary records, for
+            # each version we have reached, the next version towards
+            # self and the patchfile that leads there.
+            pred = { self : None }
+            queue = deque([self])
+            while queue:
+                pv = queue.popleft()
+                for patchfile in pv.fromPatches:
+                    fromPv = patchfile.fromPv
+                    if fromPv in pred:
+                        continue
+                    pred[fromPv] = (pv, patchfile)
+
+                    if fromPv is startPv:
+                        # Found it.  Walk back up the pred chain to
+                        # build the list of patches in the order they
+                        # must be applied.
+                        patchChain = []
+                        while pred[fromPv] is not None:
+                            fromPv, patchfile = pred[fromPv]
+                            patchChain.append(patchfile)
+                        return patchChain
+
+                    queue.append(fromPv)
+
+            # No path found.
+            return None
 
-        def getRecreateFilePlan(self, alreadyVisited = []):
+        def getRecreateFilePlan(self):
             """ Returns the tuple (startFile, startPv, plan),
             describing how to recreate the archive file for this
             version.  startFile and startPv is the Filename and
@@ -87,47 +203,53 @@ class PatchMaker:
             associated with each patch.  Returns (None, None, None) if
             there is no way to recreate this archive file.  """
 
-            if self.tempFile:
-                return (self.tempFile, self, [])
-
-            if self in alreadyVisited:
-                # We've already been here; this is a loop.  Avoid
-                # infinite recursion.
-                return (None, None, None)
+            # Search breadth-first backwards along fromPatches for the
+            # nearest version that we already have a file for.  Each
+            # version is expanded at most once.
+            pred = { self : None }
+            queue = deque([self])
+            while queue:
+                pv = queue.popleft()
+                startFile = pv.getStartFile()
+                if startFile is not None:
+                    # Walk back up the pred chain to build the plan.
+                    startPv = pv
+                    plan = []
+                    while pred[pv] is not None:
+                        patchfile, pv = pred[pv]
+                        plan.append((patchfile, pv))
+                    return (startFile, startPv, plan)
+
+                for patchfile in pv.fromPatches:
+                    fromPv = patchfile.fromPv
+                    if fromPv not in pred:
+                        pred[fromPv] = (patchfile, pv)
+                        queue.append(fromPv)
+
+            # No path found.
+            return (None, None, None)
+
+        def getStartFile(self):
+            """ Returns the Filename of a file on disk that already
+            holds the archive for this version, or None if it would
+            have to be re-created from patches. """
 
-            alreadyVisited = alreadyVisited[:]
-            alreadyVisited.append(self)
+            if self.tempFile:
+                return self.tempFile
 
             if self.packageCurrent:
                 # This PackageVersion instance represents the current
                 # version of some package.
                 package = self.packageCurrent
-                return (Filename(package.packageDir, package.compressedFilename), self, [])
+                if package.compressedPathname:
+                    return package.compressedPathname
 
             if self.packageBase:
                 # This PackageVersion instance represents the base
                 # (oldest) version of some package.
-                package = self.packageBase
-                return (Filename(package.packageDir, package.baseFile.filename  + '.pz'), self, [])
-
-            # We'll need to re-create the file.
-            bestPlan = None
-            bestStartFile = None
-            bestStartPv = None
-            for patchfile in self.fromPatches:
-                fromPv = patchfile.fromPv
-                startFile, startPv, plan = fromPv.getRecreateFilePlan(alreadyVisited)
-                if plan is not None:
-                    # There's a path through this patchfile.
-                    plan = plan + [(patchfile, self)]
-                    if bestPlan is None or len(plan) < len(bestPlan):
-                        bestPlan = plan
-                        bestStartFile = startFile
-                        bestStartPv = startPv
-
-            # Return the shortest path found, or None if there were no
-            # paths found.
-            return (bestStartFile, bestStartPv, bestPlan)
+                return self.packageBase.basePathname
+
+            return None
 
         def getFile(self):
             """ Returns the Filename of the archive file associated
@@ -135,71 +257,100 @@ class PatchMaker:
             disk, a temporary file will be created.  Returns None if
             the file can't be recreated. """
 
+            if self.tempFile:
+                # We have already re-created this file.
+                return self.tempFile
+
             startFile, startPv, plan = self.getRecreateFilePlan()
+            if startFile is None:
+                # There's no way to re-create this file.
+                return None
 
             if startFile.getExtension() in ('pz', 'gz'):
                 # If the starting file is compressed, we have to
                 # decompress it first.
                 assert startPv.tempFile is None
-                startPv.tempFile = Filename.temporary('', 'patch_')
-                if not decompressFile(startFile, startPv.tempFile):
+                tempFile = Filename.temporary('', 'patch_')
+                if not decompressFile(startFile, tempFile):
                     # Failure trying to decompress the file.
+                    tempFile.unlink()
                     return None
-                startFile = startPv.tempFile
+                startPv.tempFile = tempFile
+                startFile = tempFile
 
             if not plan:
                 # If plan is a zero-length list, we're already
-                # here--return startFile.  If plan is None, there's no
-                # solution, and startFile is None.  In either case, we
-                # can return startFile.
+                # here--return startFile.
                 return startFile
 
             # If plan is a non-empty list, we have to walk the list to
-            # apply the patch plan.
+            # apply the patch plan.  Only the final result is kept; the
+            # intermediate versions are written alternately into the
+            # same two scratch files, rather than creating a new
+            # temporary file for every step of the plan.
+            scratchFiles = [None, None]
             prevFile = startFile
-            for patchfile, pv in plan:
-                fromPv = patchfile.fromPv
+            for i, (patchfile, pv) in enumerate(plan):
+                if pv is self:
+                    result = Filename.temporary('', 'patch_')
+                else:
+                    result = scratchFiles[i % 2]
+                    if result is None:
+                        result = Filename.temporary('', 'patch_')
+                        scratchFiles[i % 2] = result
+
                 patchFilename = Filename(patchfile.package.packageDir, patchfile.file.filename)
-                result = self.applyPatch(prevFile, patchFilename)
-                if not result:
+                if not self.applyPatch(prevFile, patchFilename, result):
                     # Failure trying to re-create the file.
-                    return None
+                    result.unlink()
+                    prevFile = None
+                    break
 
-                pv.tempFile = result
                 prevFile = result
 
+            for scratchFile in scratchFiles:
+                if scratchFile is not None:
+                    scratchFile.unlink()
+
+            if prevFile is None:
+                return None
+
             # Successfully patched.
-            assert pv is self and prevFile is self.tempFile
+            assert pv is self
+            self.tempFile = prevFile
             return prevFile
 
-        def applyPatch(self, origFile, patchFilename):
+        def applyPatch(self, origFile, patchFilename, result):
             """ Applies the named patch to the indicated original
-            file, storing the results in a temporary file, and returns
-            that temporary Filename.  Returns None on failure. """
+            file, storing the results in the indicated result file.
+            Returns true on success, false on failure. """
 
-            result = Filename.temporary('', 'patch_')
             p = Patchfile()
             if not p.apply(patchFilename, origFile, result):
                 print("Internal patching failed: %s" % (patchFilename))
-                return None
+                return False
 
-            return result
+            return True
 
         def getNext(self, package):
             """ Gets the next patch in the chain towards this
             package. """
-            for patch in self.toPatches:
-                if patch.packageName == package.packageName and \
-                   patch.platform == package.platform and \
-                   patch.version == package.version and \
-                   patch.hostUrl == package.hostUrl:
-                    return patch.toPv
 
-            return None
+            if self.nextIndex is None:
+                self.nextIndex = {}
+                for patch in self.toPatches:
+                    self.nextIndex.setdefault(patch.keyPrefix, patch.toPv)
 
-    class Patchfile:
+            key = (package.packageName, package.platform, package.version, package.hostUrl)
+            return self.nextIndex.get(key, None)
+
+    class Patchfile(object):
         """ A single patchfile for a package. """
 
+        __slots__ = ('package', 'packageName', 'platform', 'version',
+                     'hostUrl', 'keyPrefix', 'file', 'sourceFile',
+                     'targetFile', 'fromPv', 'toPv')
+
         def __init__(self, package):
             self.package = package
             self.packageName = package.packageName
@@ -207,6 +358,10 @@ class PatchMaker:
             self.version = package.version
             self.hostUrl = None
 
+            # The (packageName, platform, version, hostUrl) tuple that,
+            # with a file hash, locates a PackageVersion.
+            self.keyPrefix = (self.packageName, self.platform, self.version, self.hostUrl)
+
             # FileSpec for the patchfile itself
             self.file = None
 
@@ -222,16 +377,6 @@ class PatchMaker:
             # The PackageVersion corresponding to our targetFile
             self.toPv = None
 
-        def getSourceKey(self):
-            """ Returns the key for locating the package that this
-            patchfile can be applied to. """
-            return (self.packageName, self.platform, self.version, self.hostUrl, self.sourceFile)
-
-        def getTargetKey(self):
-            """ Returns the key for locating the package that this
-            patchfile will generate. """
-            return (self.packageName, self.platform, self.version, self.hostUrl, self.targetFile)
-
         def fromFile(self, packageDir, patchFilename, sourceFile, targetFile):
             """ Creates the data structures from an existing patchfile
             on disk. """
@@ -244,23 +389,23 @@ class PatchMaker:
         def loadXml(self, xpatch):
             """ Reads the data structures from an xml file. """
 
-            self.packageName = xpatch.Attribute('name') or self.packageName
-            self.platform = xpatch.Attribute('platform') or self.platform
-            self.version = xpatch.Attribute('version') or self.version
-            self.hostUrl = xpatch.Attribute('host') or self.hostUrl
+            self.packageName = internAttribute(xpatch, 'name') or self.packageName
+            self.platform = internAttribute(xpatch, 'platform') or self.platform
+            self.version = internAttribute(xpatch, 'version') or self.version
+            self.hostUrl = internAttribute(xpatch, 'host') or self.hostUrl
+            self.keyPrefix = (self.packageName, self.platform, self.version, self.hostUrl)
 
             self.file = FileSpec()
             self.file.loadXml(xpatch)
 
-            xsource = xpatch.FirstChildElement('source')
-            if xsource:
-                self.sourceFile = FileSpec()
-                self.sourceFile.loadXml(xsource)
-
-            xtarget = xpatch.FirstChildElement('target')
-            if xtarget:
-                self.targetFile = FileSpec()
-                self.targetFile.loadXml(xtarget)
+            for xchild in iterChildElements(xpatch):
+                value = xchild.Value()
+                if value == 'source' and not self.sourceFile:
+                    self.sourceFile = FileSpec()
+                    self.sourceFile.loadXml(xchild)
+                elif value == 'target' and not self.targetFile:
+                    self.targetFile = FileSpec()
+                    self.targetFile.loadXml(xchild)
 
         def makeXml(self, package):
             xpatch = TiXmlElement('patch')
@@ -286,10 +431,18 @@ class PatchMaker:
 
             return xpatch
 
-    class Package:
+    class Package(object):
         """ This is a particular package.  This contains all of the
         information needed to reconstruct the package's desc file. """
 
+        __slots__ = ('packageDir', 'packageDesc', 'patchMaker',
+                     'contentsDocPackage', 'patchVersion', 'currentPv',
+                     'basePv', 'topPv', 'packageName', 'platform',
+                     'version', 'hostUrl', 'keyPrefix', 'currentFile',
+                     'baseFile', 'topFile', 'compressedPathname',
+                     'basePathname', 'patchFilename', 'doc',
+                     'anyChanges', 'patches', 'packageSeq')
+
         def __init__(self, packageDesc, patchMaker, xpackage = None):
             self.packageDir = Filename(patchMaker.installDir, packageDesc.getDirname())
             self.packageDesc = packageDesc
@@ -304,34 +457,32 @@ class PatchMaker:
             self.platform = None
             self.version = None
             self.hostUrl = None
+            self.keyPrefix = None
             self.currentFile = None
             self.baseFile = None
+            self.topFile = None
+
+            # The full pathnames of the compressed current and base
+            # archives on disk, computed by readDescFile().
+            self.compressedPathname = None
+            self.basePathname = None
+
+            # The name of the patch that would produce the current
+            # version, also computed by readDescFile().
+            self.patchFilename = None
 
             self.doc = None
             self.anyChanges = False
             self.patches = []
 
-        def getCurrentKey(self):
-            """ Returns the key to locate the current version of this
-            package. """
-
-            return (self.packageName, self.platform, self.version, self.hostUrl, self.currentFile)
-
-        def getBaseKey(self):
-            """ Returns the key to locate the "base" or oldest version
-            of this package. """
+            # The new seq value, set by prepareDescFile().
+            self.packageSeq = None
 
-            return (self.packageName, self.platform, self.version, self.hostUrl, self.baseFile)
+        def getImportDescFilename(self):
+            """ Returns the name of the import desc file that
+            accompanies this package's desc file. """
 
-        def getTopKey(self):
-            """ Returns the key to locate the "top" or newest version
-            of this package. """
-
-            return (self.packageName, self.platform, self.version, self.hostUrl, self.topFile)
-
-        def getGenericKey(self, fileSpec):
-            """ Returns the key that has the indicated hash. """
-            return (self.packageName, self.platform, self.version, self.hostUrl, fileSpec)
+            return str(self.packageDesc)[:-3] + 'import.xml'
 
         def readDescFile(self, doProcessing = False):
             """ Reads the existing package.xml file and stores it in
@@ -351,9 +502,20 @@ class PatchMaker:
             xpackage = self.doc.FirstChildElement('package')
             if not xpackage:
                 return False
-            self.packageName = xpackage.Attribute('name')
-            self.platform = xpackage.Attribute('platform')
-            self.version = xpackage.Attribute('version')
+            self.packageName = internAttribute(xpackage, 'name')
+            self.platform = internAttribute(xpackage, 'platform')
+            self.version = internAttribute(xpackage, 'version')
+
+            # Collect the child elements we care about in a single
+            # pass, rather than searching the children once per tag.
+            xchildren = {}
+            xpatches = []
+            for xchild in iterChildElements(xpackage):
+                value = xchild.Value()
+                if value == 'patch':
+                    xpatches.append(xchild)
+                elif value not in xchildren:
+                    xchildren[value] = xchild
 
             # All packages we defined in-line are assigned to the
             # "none" host.  TODO: support patching from packages on
@@ -361,10 +523,14 @@ class PatchMaker:
             # here for those hosts.
             self.hostUrl = None
 
+            self.keyPrefix = (self.packageName, self.platform, self.version, self.hostUrl)
+
             self.currentFile = None
             self.baseFile = None
             self.topFile = None
-            self.compressedFilename = None
+            self.compressedPathname = None
+            self.basePathname = None
+            self.patchFilename = None
             compressedFile = None
 
             # Assume there are changes for this version, until we
@@ -372,14 +538,14 @@ class PatchMaker:
             isNewVersion = True
 
             # Get the actual current version.
-            xarchive = xpackage.FirstChildElement('uncompressed_archive')
+            xarchive = xchildren.get('uncompressed_archive')
             if xarchive:
                 self.currentFile = FileSpec()
                 self.currentFile.loadXml(xarchive)
 
             # Get the top_version--the top (newest) of the patch
             # chain.
-            xarchive = xpackage.FirstChildElement('top_version')
+            xarchive = xchildren.get('top_version')
             if xarchive:
                 self.topFile = FileSpec()
                 self.topFile.loadXml(xarchive)
@@ -394,7 +560,8 @@ class PatchMaker:
             else:
                 # If there isn't a top_version yet, we have to make
                 # one, by duplicating the currentFile.
-                self.topFile = copy.copy(self.currentFile)
+                if self.currentFile:
+                    self.topFile = self.currentFile.clone()
                 self.anyChanges = True
 
             # Get the current patch version.  If we have a
@@ -420,36 +587,37 @@ class PatchMaker:
             # URL will also change, guaranteeing that users will
             # download the latest version, and not some stale cache
             # file.
-            xcompressed = xpackage.FirstChildElement('compressed_archive')
+            xcompressed = xchildren.get('compressed_archive')
             if xcompressed:
                 compressedFile = FileSpec()
                 compressedFile.loadXml(xcompressed)
 
                 oldCompressedFilename = compressedFile.filename
-                self.compressedFilename = oldCompressedFilename
+                oldCompressedPathname = Filename(self.packageDir, oldCompressedFilename)
+                self.compressedPathname = oldCompressedPathname
 
                 if doProcessing:
                     newCompressedFilename = '%s.%s.pz' % (self.currentFile.filename, self.patchVersion)
                     if newCompressedFilename != oldCompressedFilename:
-                        oldCompressedPathname = Filename(self.packageDir, oldCompressedFilename)
                         newCompressedPathname = Filename(self.packageDir, newCompressedFilename)
                         if oldCompressedPathname.renameTo(newCompressedPathname):
-                            compressedFile.fromFile(self.packageDir, newCompressedFilename)
+                            compressedFile.fromFile(self.packageDir, newCompressedFilename,
+                                                    pathname = newCompressedPathname)
                             compressedFile.storeXml(xcompressed)
 
-                        self.compressedFilename = newCompressedFilename
+                        self.compressedPathname = newCompressedPathname
                         self.anyChanges = True
 
             # Get the base_version--the bottom (oldest) of the patch
             # chain.
-            xarchive = xpackage.FirstChildElement('base_version')
+            xarchive = xchildren.get('base_version')
             if xarchive:
                 self.baseFile = FileSpec()
                 self.baseFile.loadXml(xarchive)
             else:
                 # If there isn't a base_version yet, we have to make
                 # one, by duplicating the currentFile.
-                self.baseFile = copy.copy(self.currentFile)
+                self.baseFile = self.currentFile.clone()
 
                 # Note that the we only store the compressed version
                 # of base_filename on disk, but we store the md5 of
@@ -460,33 +628,41 @@ class PatchMaker:
                 self.baseFile.filename += '.base'
 
                 # Also duplicate the (compressed) file itself.
-                if doProcessing and self.compressedFilename:
-                    fromPathname = Filename(self.packageDir, self.compressedFilename)
+                if doProcessing and self.compressedPathname:
                     toPathname = Filename(self.packageDir, self.baseFile.filename + '.pz')
-                    fromPathname.copyTo(toPathname)
+                    self.compressedPathname.copyTo(toPathname)
                 self.anyChanges = True
 
-            self.patches = []
-            xpatch = xpackage.FirstChildElement('patch')
-            while xpatch:
-                patchfile = PatchMaker.Patchfile(self)
-                patchfile.loadXml(xpatch)
-                self.patches.append(patchfile)
-                xpatch = xpatch.NextSiblingElement('patch')
+            self.basePathname = Filename(self.packageDir, self.baseFile.filename + '.pz')
+            if self.currentFile:
+                self.patchFilename = Filename('%s.%s.patch' % (self.currentFile.filename, self.patchVersion))
+
+            self.patches = [self.makePatchfile(xpatch) for xpatch in xpatches]
 
             return True
 
-        def writeDescFile(self):
-            """ Rewrites the desc file with the new patch
-            information. """
+        def makePatchfile(self, xpatch):
+            """ Returns a new Patchfile for this package, read from
+            the indicated <patch> element. """
+
+            patchfile = PatchMaker.Patchfile(self)
+            patchfile.loadXml(xpatch)
+            return patchfile
 
+        def prepareDescFile(self):
+            """ Updates the desc file document, and the import desc
+            file document, in memory with the new patch information.
+            Returns a list of the TiXmlDocuments that must be saved
+            before updateContentsDocPackage() is called. """
+
+            self.packageSeq = None
             if not self.anyChanges:
                 # No need to rewrite.
-                return
+                return []
 
             xpackage = self.doc.FirstChildElement('package')
             if not xpackage:
-                return
+                return []
 
             packageSeq = SeqValue()
             packageSeq.loadXml(xpackage, 'seq')
@@ -495,12 +671,8 @@ class PatchMaker:
 
             # Remove all of the old patch entries from the desc file
             # we read earlier.
-            xremove = []
-            for value in ['base_version', 'top_version', 'patch']:
-                xpatch = xpackage.FirstChildElement(value)
-                while xpatch:
-                    xremove.append(xpatch)
-                    xpatch = xpatch.NextSiblingElement(value)
+            xremove = [xchild for xchild in iterChildElements(xpackage)
+                       if xchild.Value() in ('base_version', 'top_version', 'patch')]
 
             for xelement in xremove:
                 xpackage.RemoveChild(xelement)
@@ -523,22 +695,34 @@ class PatchMaker:
                 xpatch = patchfile.makeXml(self)
                 xpackage.InsertEndChild(xpatch)
 
-            self.doc.SaveFile()
+            self.packageSeq = packageSeq
+            docs = [self.doc]
 
             # Also copy the seq to the import desc file, for
             # documentation purposes.
 
-            importDescFilename = str(self.packageDesc)[:-3] + 'import.xml'
-            importDescFullpath = Filename(self.patchMaker.installDir, importDescFilename)
+            importDescFullpath = Filename(self.patchMaker.installDir, self.getImportDescFilename())
             doc = TiXmlDocument(importDescFullpath.toOsSpecific())
             if doc.LoadFile():
                 xpackage = doc.FirstChildElement('package')
                 if xpackage:
                     packageSeq.storeXml(xpackage, 'seq')
-                    doc.SaveFile()
+                    docs.append(doc)
             else:
                 print("Couldn't read %s" % (importDescFullpath))
 
+            return docs
+
+        def updateContentsDocPackage(self):
+            """ Updates this package's element within the contents.xml
+            document to reference the desc files written out after
+            prepareDescFile(). """
+
+            packageSeq = self.packageSeq
+            if packageSeq is None:
+                # The desc file wasn't rewritten.
+                return
+
             if self.contentsDocPackage:
                 # Now that we've rewritten the xml file, we have to
                 # change the contents.xml file that references it to
@@ -551,7 +735,7 @@ class PatchMaker:
                 ximport = self.contentsDocPackage.FirstChildElement('import')
                 if ximport:
                     fileSpec = FileSpec()
-                    fileSpec.fromFile(self.patchMaker.installDir, importDescFilename)
+                    fileSpec.fromFile(self.patchMaker.installDir, self.getImportDescFilename())
                     fileSpec.storeXml(ximport)
 
                 # Also copy the package seq value into the
@@ -562,17 +746,48 @@ class PatchMaker:
 
 
     # PatchMaker constructor.
-    def __init__(self, installDir):
+    def __init__(self, installDir, patchCompressionLevel = None,
+                 buildProcesses = 1, maxPatchArchiveSize = None):
         self.installDir = installDir
         self.packageVersions = {}
         self.packages = []
 
+        # The zlib compression level, 0 - 9, of the patchfiles we
+        # build, or -1 for zlib's default.  Level 9 takes several
+        # times as long as the default of 6, for very little gain on
+        # typical patch data.  buildPatches() checks that the level
+        # is in range.
+        if patchCompressionLevel is None:
+            patchCompressionLevel = ConfigVariableInt('patch-compression-level', 6).getValue()
+        self.patchCompressionLevel = patchCompressionLevel
+
+        # The number of worker processes with which to build patches
+        # for different packages in parallel.  The default of 1 builds
+        # them one at a time, in this process.
+        self.buildProcesses = buildProcesses
+
+        # The largest uncompressed archive, in bytes, that we will
+        # attempt to build a patch from or to.  Diffing very large
+        # archives takes a long time and a great deal of memory, and
+        # rarely saves much.  The default of 0 means no limit.
+        if maxPatchArchiveSize is None:
+            maxPatchArchiveSize = ConfigVariableInt64('patch-max-archive-size', 0).getValue()
+        self.maxPatchArchiveSize = maxPatchArchiveSize
+
+        # The C++ Patchfile object with which we build patches in this
+        # process.  See getPatchfileBuilder().
+        self.patchfileBuilder = None
+
     def buildPatches(self, packageNames = None):
         """ Makes the patches required in a particular directory
         structure on disk.  If packageNames is None, this makes
         patches for all packages; otherwise, it should be a list of
         package name strings, limiting the set of packages that are
-        processed. """
+        processed.  Raises ValueError if patchCompressionLevel is
+        not a valid zlib compression level. """
+
+        if self.patchCompressionLevel < -1 or self.patchCompressionLevel > 9:
+            raise ValueError("Invalid patch compression level: %s" % (self.patchCompressionLevel))
 
         if not self.readContentsFile():
             return False
@@ -593,6 +808,19 @@ class PatchMaker:
         for pv in self.packageVersions.values():
             pv.cleanup()
 
+        # Release the hash table held by the patch builder.
+        self.patchfileBuilder = None
+
+    def getPatchfileBuilder(self):
+        """ Returns the C++ Patchfile object with which to build
+        patches in this process, creating it the first time.  It
+        allocates a 64 MB hash table on its first build and keeps it
+        for later builds, so we create only one, until cleanup(). """
+
+        if self.patchfileBuilder is None:
+            self.patchfileBuilder = Patchfile()  # The C++ class
+        return self.patchfileBuilder
+
     def getPatchChainToCurrent(self, descFilename, fileSpec):
         """ Reads the package defined in the indicated desc file, and
         constructs a patch chain from the version represented by
@@ -604,7 +832,7 @@ class PatchMaker:
             return None
 
         self.buildPatchChains()
-        fromPv = self.getPackageVersion(package.getGenericKey(fileSpec))
+        fromPv = self.getPackageVersion(package.keyPrefix, fileSpec)
         toPv = package.currentPv
 
         patchChain = None
@@ -665,26 +893,34 @@ class PatchMaker:
 
         # We also have to write the desc file for all packages that
         # might need it, because we might have changed some of them on
-        # read.
+        # read.  Update all of the documents in memory first, and
+        # then write them out together.
+        docs = []
         for package in self.packages:
-            package.writeDescFile()
+            docs += package.prepareDescFile()
+
+        for doc in docs:
+            doc.SaveFile()
+
+        # Now that the desc files are on disk, we can record their
+        # new hashes in each package's element within the
+        # contents.xml document, and write out that document.
+        for package in self.packages:
+            package.updateContentsDocPackage()
 
-        # The above writeDescFile() call should also update each
-        # package's element within the contents.xml document, so all
-        # we have to do now is write out the document.
         self.contentsDoc.SaveFile()
 
-    def getPackageVersion(self, key):
+    def getPackageVersion(self, prefix, file):
         """ Returns a shared PackageVersion object for the indicated
-        key. """
-
-        packageName, platform, version, hostUrl, file = key
+        file of the package identified by prefix, a (packageName,
+        platform, version, hostUrl) tuple. """
 
         # We actually key on the hash, not the FileSpec itself.
-        k = (packageName, platform, version, hostUrl, file.hash)
+        k = prefix + (file.hash,)
         pv = self.packageVersions.get(k, None)
-        if not pv:
-            pv = self.PackageVersion(*key)
+        if pv is None:
+            packageName, platform, version, hostUrl = prefix
+            pv = self.PackageVersion(packageName, platform, version, hostUrl, file)
             self.packageVersions[k] = pv
         return pv
 
@@ -694,37 +930,55 @@ class PatchMaker:
 
         self.patchFilenames = {}
 
+        getPackageVersion = self.getPackageVersion
+        recordPatchfile = self.recordPatchfile
+
         for package in self.packages:
-            if not package.baseFile:
+            baseFile = package.baseFile
+            if not baseFile:
                 # This package doesn't have any versions yet.
                 continue
 
-            currentPv = self.getPackageVersion(package.getCurrentKey())
+            currentFile = package.currentFile
+            topFile = package.topFile
+            prefix = package.keyPrefix
+
+            currentPv = getPackageVersion(prefix, currentFile)
             package.currentPv = currentPv
             currentPv.packageCurrent = package
-            currentPv.printName = package.currentFile.filename
+            currentPv.printName = currentFile.filename
 
-            basePv = self.getPackageVersion(package.getBaseKey())
+            # The base and top versions are often the very same file
+            # as the current version, in which case they share its
+            # PackageVersion and we needn't look them up again.
+            if baseFile.hash == currentFile.hash:
+                basePv = currentPv
+            else:
+                basePv = getPackageVersion(prefix, baseFile)
             package.basePv = basePv
             basePv.packageBase = package
-            basePv.printName = package.baseFile.filename
+            basePv.printName = baseFile.filename
 
-            topPv = self.getPackageVersion(package.getTopKey())
+            if topFile.hash == currentFile.hash:
+                topPv = currentPv
+            else:
+                topPv = getPackageVersion(prefix, topFile)
             package.topPv = topPv
             topPv.packageTop = package
 
             for patchfile in package.patches:
-                self.recordPatchfile(patchfile)
+                recordPatchfile(patchfile)
 
     def recordPatchfile(self, patchfile):
         """ Adds the indicated patchfile to the patch chains. """
         self.patchFilenames[patchfile.file.filename] = patchfile
 
-        fromPv = self.getPackageVersion(patchfile.getSourceKey())
+        fromPv = self.getPackageVersion(patchfile.keyPrefix, patchfile.sourceFile)
         patchfile.fromPv = fromPv
         fromPv.toPatches.append(patchfile)
+        fromPv.nextIndex = None
 
-        toPv = self.getPackageVersion(patchfile.getTargetKey())
+        toPv = self.getPackageVersion(patchfile.keyPrefix, patchfile.targetFile)
         patchfile.toPv = toPv
         toPv.fromPatches.append(patchfile)
         toPv.printName = patchfile.file.filename
@@ -732,13 +986,16 @@ class PatchMaker:
     def processSomePackages(self, packageNames):
         """ Builds missing patches only for the named packages. """
 
+        packages = []
         remainingNames = packageNames[:]
         for package in self.packages:
             if package.packageName in packageNames:
-                self.processPackage(package)
+                packages.append(package)
             if package.packageName in remainingNames:
                 remainingNames.remove(package.packageName)
 
+        self.processPackages(packages)
+
         if remainingNames:
             print("Unknown packages: %s" % (remainingNames,))
 
@@ -746,42 +1003,222 @@ class PatchMaker:
         """ Walks through the list of packages, and builds missing
         patches for each one. """
 
-        for package in self.packages:
-            self.processPackage(package)
+        self.processPackages(self.packages)
+
+    def processPackages(self, packages):
+        """ Builds missing patches for each of the indicated packages.
+        If buildProcesses is greater than 1, the patches are built
+        and compressed in that many worker processes. """
+
+        if self.buildProcesses <= 1:
+            for package in packages:
+                self.processPackage(package)
+            return
+
+        # Imported here, since PatchMaker is also used at runtime to
+        # apply patches, which never needs it.
+        import multiprocessing
+
+        # Note that we use worker processes, not a thread pool.  The
+        # C++ Patchfile doesn't release the GIL while it builds a
+        # patch, and its tar reader keeps static state, so it isn't
+        # safe to call from more than one thread at once anyway.
+
+        # Re-create the source files for all of the patches first,
+        # here in this process, since that walks the shared patch
+        # chains.
+        patches = []
+        jobs = []
+        for package in packages:
+            patch = self.getMissingPatch(package)
+            if not patch:
+                continue
+            v1, v2, filename = patch
+            job = self.makePatchJob(v1, v2, package, filename)
+            if not job:
+                raise Exception("Couldn't build patch.")
+            patches.append((v1, v2, package, filename))
+            jobs.append(job)
+
+        if not jobs:
+            return
+
+        pool = multiprocessing.Pool(min(self.buildProcesses, len(jobs)))
+        try:
+            results = pool.map(buildPatchJob, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        # Now record the new patchfiles, in order.
+        for (v1, v2, package, filename), result in zip(patches, results):
+            if not result:
+                raise Exception("Couldn't build patch.")
+            self.addPatchfile(v1, v2, package, filename)
 
     def processPackage(self, package):
         """ Builds missing patches for the indicated package. """
 
+        patch = self.getMissingPatch(package)
+        if patch:
+            v1, v2, filename = patch
+            if not self.buildPatch(v1, v2, package, filename):
+                raise Exception("Couldn't build patch.")
+
+    def getMissingPatch(self, package):
+        """ Returns the tuple (v1, v2, patchFilename), describing the
+        patch that needs to be built for the indicated package, or
+        None if the package needs no new patch. """
+
         if not package.baseFile:
             # No versions.
-            return
+            return None
 
         # What's the current version on the top of the tree?
         topPv = package.topPv
         currentPv = package.currentPv
 
-        if topPv != currentPv:
-            # They're different, so build a new patch.
-            filename = Filename(package.currentFile.filename + '.%s.patch' % (package.patchVersion))
-            assert filename not in self.patchFilenames
-            if not self.buildPatch(topPv, currentPv, package, filename):
-                raise Exception("Couldn't build patch.")
+        if topPv.file.hash == currentPv.file.hash:
+            # The top version already has the current contents, even
+            # if the archive was rebuilt with a new timestamp.
+            return None
+
+        # If we have already built a patch between these same two
+        # versions (for instance, the package was rolled back and
+        # then forward again), there's no need to build it again.
+        # The current version simply becomes the new top.
+        for patchfile in topPv.toPatches:
+            if patchfile.toPv == currentPv:
+                print("Reusing patch %s" % (patchfile.file.filename))
+                package.topPv = currentPv
+                currentPv.packageTop = package
+                package.anyChanges = True
+                return None
+
+        maxSize = self.maxPatchArchiveSize
+        if maxSize > 0 and max(topPv.file.size, currentPv.file.size) > maxSize:
+            # Too large to be worth patching.  Clients with older
+            # versions will download the full archive instead.
+            if self.rebasePackage(package):
+                print("Not building patch for %s; archive is too large" % (currentPv.printName))
+                return None
+
+        # They're different, so build a new patch.
+        filename = package.patchFilename
+        # patchFilenames is keyed on the name of the compressed patch.
+        assert filename.getFullpath() + '.pz' not in self.patchFilenames
+        return (topPv, currentPv, filename)
+
+    def rebasePackage(self, package):
+        """ Makes the current version of the indicated package its
+        new base and top version, in place of building a patch to it
+        from the previous top version.  Clients with older versions
+        will download the full archive instead.  Returns true on
+        success, false if the current compressed archive could not be
+        copied to serve as the new base. """
+
+        compressedPathname = package.compressedPathname
+        if not compressedPathname:
+            return False
+
+        baseFile = package.currentFile.clone()
+        baseFile.filename += '.base'
+        basePathname = Filename(package.packageDir, baseFile.filename + '.pz')
+        if not compressedPathname.copyTo(basePathname):
+            return False
+
+        currentPv = package.currentPv
+        package.basePv.packageBase = None
+        package.topPv.packageTop = None
+
+        package.baseFile = baseFile
+        package.basePathname = basePathname
+        package.basePv = currentPv
+        currentPv.packageBase = package
+        package.topPv = currentPv
+        currentPv.packageTop = package
+        package.anyChanges = True
+
+        self.prunePatches(package)
+        return True
+
+    def prunePatches(self, package):
+        """ Removes from the indicated package, and from the patch
+        chains, any patches that can no longer lead to its current
+        version, for instance because the current version has just
+        become the new base.  The patch files themselves are left on
+        disk, since clients that read the old desc file may still be
+        downloading them. """
+
+        # Find every version that can reach the current version, by
+        # searching backwards along fromPatches.
+        reachable = set([package.currentPv])
+        queue = deque([package.currentPv])
+        while queue:
+            pv = queue.popleft()
+            for patchfile in pv.fromPatches:
+                if patchfile.fromPv not in reachable:
+                    reachable.add(patchfile.fromPv)
+                    queue.append(patchfile.fromPv)
+
+        patches = []
+        for patchfile in package.patches:
+            if patchfile.toPv in reachable:
+                patches.append(patchfile)
+                continue
+
+            fromPv = patchfile.fromPv
+            fromPv.toPatches.remove(patchfile)
+            fromPv.nextIndex = None
+            patchfile.toPv.fromPatches.remove(patchfile)
+            self.patchFilenames.pop(patchfile.file.filename, None)
+
+        package.patches = patches
 
     def buildPatch(self, v1, v2, package, patchFilename):
         """ Builds a patch from PackageVersion v1 to PackageVersion
         v2, and stores it in patchFilename.pz.  Returns true on
         success, false on failure."""
 
-        pathname = Filename(package.packageDir, patchFilename)
-        if not self.buildPatchFile(v1.getFile(), v2.getFile(), pathname,
-                                   v1.printName, v2.printName):
+        job = self.makePatchJob(v1, v2, package, patchFilename)
+        if not job or not buildPatchJob(job, self.getPatchfileBuilder()):
             return False
 
-        compressedPathname = Filename(pathname + '.pz')
-        compressedPathname.unlink()
-        if not compressFile(pathname, compressedPathname, 9):
-            raise Exception("Couldn't compress patch.")
-        pathname.unlink()
+        self.addPatchfile(v1, v2, package, patchFilename)
+        return True
+
+    def makePatchJob(self, v1, v2, package, patchFilename):
+        """ Re-creates the archive files for PackageVersions v1 and
+        v2 as needed, and returns the job tuple to pass to
+        buildPatchJob() to build the patch between them.  Returns
+        None if there is no original version to patch from. """
+
+        origFilename = v1.getFile()
+        newFilename = v2.getFile()
+        if not origFilename or not origFilename.exists():
+            # No original version to patch from.
+            return None
+
+        print("Building patch from %s to %s" % (v1.printName, v2.printName))
+        pathname = Filename(package.packageDir, patchFilename)
+        return (origFilename.toOsSpecific(), newFilename.toOsSpecific(),
+                pathname.toOsSpecific(), self.patchCompressionLevel)
+
+    def addPatchfile(self, v1, v2, package, patchFilename):
+        """ Adds the newly-built patchfile patchFilename.pz, from
+        PackageVersion v1 to PackageVersion v2, to the indicated
+        package and to the patch chains. """
+
+        pathname = Filename(package.packageDir, patchFilename + '.pz')
+        if package.compressedPathname and \
+           pathname.getFileSize() >= package.compressedPathname.getFileSize():
+            # The client always prefers a patch chain when there is
+            # one, so a patch that is no smaller than the full archive
+            # is worse than none at all.
+            if self.rebasePackage(package):
+                print("Discarding patch %s; it is no smaller than the full archive" % (pathname))
+                pathname.unlink()
+                return
 
         patchfile = self.Patchfile(package)
         patchfile.fromFile(package.packageDir, patchFilename + '.pz',
@@ -790,25 +1227,3 @@ class PatchMaker:
         package.anyChanges = True
 
         self.recordPatchfile(patchfile)
-
-        return True
-
-    def buildPatchFile(self, origFilename, newFilename, patchFilename,
-                       printOrigName, printNewName):
-        """ Creates a patch file from origFilename to newFilename,
-        storing the result in patchFilename.  Returns true on success,
-        false on failure. """
-
-        if not origFilename.exists():
-            # No original version to patch from.
-            return False
-
-        print("Building patch from %s to %s" % (printOrigName, printNewName))
-        patchFilename.unlink()
-        p = Patchfile()  # The C++ class
-        if p.build(origFilename, newFilename, patchFilename):
-            return True
-
-        # Unable to build a patch for some reason.
-        patchFilename.unlink()
-        return False
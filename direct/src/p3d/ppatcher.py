@@ -51,6 +51,28 @@ Options:
      The full path to the install directory.  This should be the same
      directory named by the -i parameter to ppackage.
 
+  -l level
+     The zlib compression level, 0 - 9, or -1 for zlib's default,
+     with which to compress the generated patches.  Lower levels
+     build faster; higher levels produce slightly smaller patches.
+     The default is 6, or the value of the patch-compression-level
+     config variable.
+
+  -j processes
+     The number of worker processes with which to build the patches
+     for different packages in parallel.  The default is 1, or the
+     value of the patch-build-processes config variable.  This uses
+     the multiprocessing module, so it is only useful when running
+     ppatcher directly, not from a packaged p3d file.
+
+  -s max_size
+     The largest uncompressed archive, in bytes, to build a patch from
+     or to.  A package whose archive exceeds this gets no patch; its
+     current version becomes the start of a new patch chain, and users
+     with older versions download the entire file.  The default is 0,
+     meaning no limit, or the value of the patch-max-archive-size
+     config variable.
+
   -h
      Display this help
 
@@ -61,41 +83,77 @@ import getopt
 import os
 
 from direct.p3d.PatchMaker import PatchMaker
-from panda3d.core import Filename
+from panda3d.core import Filename, ConfigVariableInt
 
 def usage(code, msg = ''):
     sys.stderr.write(usageText % {'prog' : os.path.split(sys.argv[0])[1]})
     sys.stderr.write(msg + '\n')
     sys.exit(code)
 
-try:
-    opts, args = getopt.getopt(sys.argv[1:], 'i:h')
-except getopt.error as msg:
-    usage(1, msg)
-
-installDir = None
-for opt, arg in opts:
-    if opt == '-i':
-        installDir = Filename.fromOsSpecific(arg)
-
-    elif opt == '-h':
-        usage(0)
-    else:
-        print('illegal option: ' + arg)
-        sys.exit(1)
-
-packageNames = args
-
-if not installDir:
-    installDir = Filename('install')
-
-if not packageNames:
-    # "None" means all packages.
-    packageNames = None
-
-pm = PatchMaker(installDir)
-pm.buildPatches(packageNames = packageNames)
-
-# An explicit call to exit() is required to exit the program, when
-# this module is packaged in a p3d file.
-sys.exit(0)
+def main(appRunner = None):
+    """ Runs ppatcher.  When it is packaged in a p3d file, this is
+    called by the AppRunner, which passes itself as appRunner. """
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'i:l:j:s:h')
+    except getopt.error as msg:
+        usage(1, msg)
+
+    installDir = None
+    compressionLevel = None
+    buildProcesses = None
+    maxArchiveSize = None
+    for opt, arg in opts:
+        if opt == '-i':
+            installDir = Filename.fromOsSpecific(arg)
+        elif opt == '-l':
+            try:
+                compressionLevel = int(arg)
+            except ValueError:
+                usage(1, 'Invalid compression level: %s' % (arg))
+        elif opt == '-j':
+            try:
+                buildProcesses = int(arg)
+            except ValueError:
+                usage(1, 'Invalid number of processes: %s' % (arg))
+        elif opt == '-s':
+            try:
+                maxArchiveSize = int(arg)
+            except ValueError:
+                usage(1, 'Invalid archive size: %s' % (arg))
+
+        elif opt == '-h':
+            usage(0)
+        else:
+            print('illegal option: ' + arg)
+            sys.exit(1)
+
+    packageNames = args
+
+    if not installDir:
+        installDir = Filename('install')
+
+    if not packageNames:
+        # "None" means all packages.
+        packageNames = None
+
+    if buildProcesses is None:
+        buildProcesses = ConfigVariableInt('patch-build-processes', 1).getValue()
+
+    pm = PatchMaker(installDir, patchCompressionLevel = compressionLevel,
+                    buildProcesses = buildProcesses,
+                    maxPatchArchiveSize = maxArchiveSize)
+    try:
+        pm.buildPatches(packageNames = packageNames)
+    except ValueError as e:
+        usage(1, str(e))
+
+    # An explicit call to exit() is required to exit the program,
+    # when this module is packaged in a p3d file.
+    sys.exit(0)
+
+if __name__ == '__main__':
+    # The guard keeps the worker processes started by -j, which
+    # re-import this module under the spawn start method, from
+    # running ppatcher all over again.
+    main()
@@ -1358,6 +1358,32 @@ bool Patchfile::
 build(Filename file_orig, Filename file_new, Filename patch_name) {
   patch_name.set_binary();
 
+  // Open patch file for write
+  pofstream write_stream;
+  if (!patch_name.open_write(write_stream)) {
+    express_cat.error()
+      << "Patchfile::build() - Failed to open file: " << patch_name << endl;
+    return false;
+  }
+
+  if (!build(file_orig, file_new, write_stream)) {
+    // Don't leave a truncated or partial patch file behind.
+    write_stream.close();
+    patch_name.unlink();
+    return false;
+  }
+
+  return true;
+}
+
+/**
+ * As above, but writes the patch to the indicated stream instead of to a
+ * file.  The stream is written sequentially, and is never sought, so it may
+ * be an OCompressStream, for instance, to compress the patch as it is
+ * built.  return false on error
+ */
+bool Patchfile::
+build(Filename file_orig, Filename file_new, ostream &write_stream) {
   // Open the original file for read
   pifstream stream_orig;
   file_orig.set_binary();
@@ -1376,14 +1402,6 @@ build(Filename file_orig, Filename file_new, Filename patch_name) {
     return false;
   }
 
-  // Open patch file for write
-  pofstream write_stream;
-  if (!patch_name.open_write(write_stream)) {
-    express_cat.error()
-      << "Patchfile::build() - Failed to open file: " << patch_name << endl;
-    return false;
-  }
-
   _last_copy_pos = 0;
   _add_pos = 0;
   _cache_add_data = string();
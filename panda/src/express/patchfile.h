@@ -43,6 +43,7 @@ PUBLISHED:
   ~Patchfile();
 
   bool build(Filename file_orig, Filename file_new, Filename patch_name);
+  bool build(Filename file_orig, Filename file_new, ostream &write_stream);
   int read_header(const Filename &patch_file);
 
   int initiate(const Filename &patch_file, const Filename &file);
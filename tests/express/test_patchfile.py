@@ -0,0 +1,75 @@
+import random
+import pytest
+from panda3d import core
+
+# Patchfile requires OpenSSL, and OCompressStream requires zlib.
+pytestmark = pytest.mark.skipif(
+    not hasattr(core, 'Patchfile') or not hasattr(core, 'OCompressStream'),
+    reason="requires Patchfile and OCompressStream")
+
+
+def make_files(tmpdir):
+    """Writes an original file and a modified new version of it, and returns
+    their Filenames along with the new file's contents."""
+    rand = random.Random(1234)
+    orig_data = bytes(bytearray(rand.getrandbits(8) for i in range(65536)))
+
+    # Change some bytes in the middle, insert a run, and append a tail.
+    new_data = bytearray(orig_data)
+    new_data[1000:1100] = b'x' * 100
+    new_data[30000:30000] = b'inserted data' * 50
+    new_data += b'tail' * 256
+    new_data = bytes(new_data)
+
+    p = tmpdir.join('orig.bin')
+    p.write(orig_data, mode='wb')
+    orig_filename = core.Filename.from_os_specific(str(p))
+
+    p = tmpdir.join('new.bin')
+    p.write(new_data, mode='wb')
+    new_filename = core.Filename.from_os_specific(str(p))
+
+    return orig_filename, new_filename, new_data
+
+
+def test_patchfile_build_stream(tmpdir):
+    """Tests building a patch into an OCompressStream, and applying it."""
+    orig_filename, new_filename, new_data = make_files(tmpdir)
+
+    # Build the patch, compressing it as it is written.
+    pz_filename = core.Filename.from_os_specific(str(tmpdir.join('patch.pz')))
+    pz_filename.set_binary()
+    vfs = core.VirtualFileSystem.get_global_ptr()
+    stream = vfs.open_write_file(pz_filename, False, True)
+    assert stream
+
+    compress = core.OCompressStream(stream, False, 6)
+    assert core.Patchfile().build(orig_filename, new_filename, compress)
+    compress.close()
+    assert not compress.fail()
+    assert not stream.fail()
+    vfs.close_write_file(stream)
+
+    # It should decompress to the same patch that the Filename version of
+    # build() writes.
+    patch_filename = core.Filename.from_os_specific(str(tmpdir.join('patch')))
+    assert core.decompress_file(pz_filename, patch_filename)
+
+    ref_filename = core.Filename.from_os_specific(str(tmpdir.join('ref.patch')))
+    assert core.Patchfile().build(orig_filename, new_filename, ref_filename)
+    assert tmpdir.join('patch').read(mode='rb') == tmpdir.join('ref.patch').read(mode='rb')
+
+    # Now apply it, and make sure we get the new file back.
+    result_filename = core.Filename.from_os_specific(str(tmpdir.join('result.bin')))
+    assert core.Patchfile().apply(patch_filename, orig_filename, result_filename)
+    assert tmpdir.join('result.bin').read(mode='rb') == new_data
+
+
+def test_patchfile_build_missing_orig(tmpdir):
+    """Tests that a failed build doesn't leave a patch file behind."""
+    orig_filename, new_filename, new_data = make_files(tmpdir)
+    tmpdir.join('orig.bin').remove()
+
+    patch_filename = core.Filename.from_os_specific(str(tmpdir.join('patch')))
+    assert not core.Patchfile().build(orig_filename, new_filename, patch_filename)
+    assert not tmpdir.join('patch').exists()
@@ -0,0 +1,408 @@
+import random
+import pytest
+from panda3d import core
+
+from direct.p3d.FileSpec import FileSpec
+from direct.p3d.SeqValue import SeqValue
+from direct.p3d.PatchMaker import PatchMaker, iterChildElements
+
+# Reading and writing desc files requires TinyXML.
+requires_xml = pytest.mark.skipif(
+    not hasattr(core, 'TiXmlDocument'),
+    reason="requires TiXmlDocument")
+
+# The (packageName, platform, version, hostUrl) of the package that the
+# in-memory patch graphs below belong to.
+PREFIX = ('pkg', 'linux', '1.0', None)
+
+
+def make_spec(name):
+    """Returns a FileSpec for an archive or patch with the given name.  The
+    name doubles as the hash, which is what PackageVersions are keyed on."""
+    spec = FileSpec()
+    spec.filename = name
+    spec.hash = name
+    return spec
+
+
+def make_graph(edges):
+    """Returns a PatchMaker, and the Package within it, whose patch chains
+    hold a patch for each (source, target) pair of version names."""
+    pm = PatchMaker(core.Filename('install'))
+    pm.patchFilenames = {}
+
+    package = PatchMaker.Package(core.Filename('pkg/pkg.xml'), pm)
+    package.packageName, package.platform, package.version, package.hostUrl = PREFIX
+    package.keyPrefix = PREFIX
+
+    for source, target in edges:
+        patchfile = PatchMaker.Patchfile(package)
+        patchfile.file = make_spec('%s_%s.patch' % (source, target))
+        patchfile.sourceFile = make_spec(source)
+        patchfile.targetFile = make_spec(target)
+        package.patches.append(patchfile)
+        pm.recordPatchfile(patchfile)
+
+    return pm, package
+
+
+def get_pv(pm, name):
+    """Returns the PackageVersion for the named version."""
+    return pm.getPackageVersion(PREFIX, make_spec(name))
+
+
+def patch_names(patches):
+    return [patchfile.file.filename for patchfile in patches]
+
+
+def test_patch_chain_zero_length():
+    pm, package = make_graph([('a', 'b')])
+    pv = get_pv(pm, 'b')
+    assert pv.getPatchChain(pv) == []
+
+
+def test_patch_chain_linear():
+    pm, package = make_graph([('a', 'b'), ('b', 'c'), ('c', 'd')])
+    chain = get_pv(pm, 'd').getPatchChain(get_pv(pm, 'a'))
+    assert patch_names(chain) == ['a_b.patch', 'b_c.patch', 'c_d.patch']
+
+
+def test_patch_chain_diamond():
+    # Two routes from a to d; the one through e is shorter.
+    pm, package = make_graph([('a', 'b'), ('b', 'c'), ('c', 'd'),
+                              ('a', 'e'), ('e', 'd')])
+    chain = get_pv(pm, 'd').getPatchChain(get_pv(pm, 'a'))
+    assert patch_names(chain) == ['a_e.patch', 'e_d.patch']
+
+    # But we can still get to c, which is only on the longer route.
+    chain = get_pv(pm, 'c').getPatchChain(get_pv(pm, 'a'))
+    assert patch_names(chain) == ['a_b.patch', 'b_c.patch']
+
+
+def test_patch_chain_cyclic():
+    # A package that was rolled back and then forward again.
+    pm, package = make_graph([('a', 'b'), ('b', 'a'), ('b', 'c'), ('c', 'b')])
+    chain = get_pv(pm, 'c').getPatchChain(get_pv(pm, 'a'))
+    assert patch_names(chain) == ['a_b.patch', 'b_c.patch']
+
+    chain = get_pv(pm, 'a').getPatchChain(get_pv(pm, 'c'))
+    assert patch_names(chain) == ['c_b.patch', 'b_a.patch']
+
+
+def test_patch_chain_unreachable():
+    pm, package = make_graph([('a', 'b'), ('b', 'a'), ('c', 'd')])
+
+    # Patches only go one way, and the cycle must not loop forever.
+    assert get_pv(pm, 'd').getPatchChain(get_pv(pm, 'a')) is None
+    assert get_pv(pm, 'a').getPatchChain(get_pv(pm, 'd')) is None
+    assert get_pv(pm, 'c').getPatchChain(get_pv(pm, 'd')) is None
+
+
+def test_recreate_plan_from_base():
+    pm, package = make_graph([('a', 'b'), ('b', 'c'), ('c', 'd'),
+                              ('a', 'e'), ('e', 'd')])
+    package.basePathname = core.Filename('pkg/a.base.pz')
+    get_pv(pm, 'a').packageBase = package
+
+    startFile, startPv, plan = get_pv(pm, 'c').getRecreateFilePlan()
+    assert startFile == package.basePathname
+    assert startPv is get_pv(pm, 'a')
+    assert [(patchfile.file.filename, pv) for patchfile, pv in plan] == [
+        ('a_b.patch', get_pv(pm, 'b')),
+        ('b_c.patch', get_pv(pm, 'c')),
+    ]
+
+    # The shorter route to d is taken.
+    startFile, startPv, plan = get_pv(pm, 'd').getRecreateFilePlan()
+    assert startPv is get_pv(pm, 'a')
+    assert patch_names(patchfile for patchfile, pv in plan) == ['a_e.patch', 'e_d.patch']
+
+
+def test_recreate_plan_nearest_start():
+    pm, package = make_graph([('a', 'b'), ('b', 'c'), ('c', 'd')])
+    package.basePathname = core.Filename('pkg/a.base.pz')
+    get_pv(pm, 'a').packageBase = package
+
+    # A version that has already been re-created is a closer start.
+    get_pv(pm, 'b').tempFile = core.Filename('b.tmp')
+    startFile, startPv, plan = get_pv(pm, 'd').getRecreateFilePlan()
+    assert startFile == core.Filename('b.tmp')
+    assert startPv is get_pv(pm, 'b')
+    assert patch_names(patchfile for patchfile, pv in plan) == ['b_c.patch', 'c_d.patch']
+
+    # A version that is on disk is its own start, with an empty plan.
+    startFile, startPv, plan = get_pv(pm, 'b').getRecreateFilePlan()
+    assert startPv is get_pv(pm, 'b')
+    assert plan == []
+
+
+def test_recreate_plan_unreachable():
+    pm, package = make_graph([('a', 'b'), ('c', 'd')])
+    package.basePathname = core.Filename('pkg/a.base.pz')
+    get_pv(pm, 'a').packageBase = package
+
+    assert get_pv(pm, 'd').getRecreateFilePlan() == (None, None, None)
+
+
+def make_filename(path):
+    return core.Filename.from_os_specific(str(path))
+
+
+@pytest.fixture
+def install(tmpdir):
+    """Returns an install directory holding a contents.xml that lists a
+    single package, pkg, with no versions yet."""
+    install = tmpdir.mkdir('install')
+    install.mkdir('pkg')
+
+    doc = core.TiXmlDocument(str(install.join('contents.xml')))
+    xcontents = core.TiXmlElement('contents')
+    xcontents.SetAttribute('seq', '1')
+    xpackage = core.TiXmlElement('package')
+    xpackage.SetAttribute('name', 'pkg')
+    xpackage.SetAttribute('platform', 'linux')
+    xpackage.SetAttribute('version', '1.0')
+    xpackage.SetAttribute('filename', 'pkg/pkg.xml')
+    ximport = core.TiXmlElement('import')
+    ximport.SetAttribute('filename', 'pkg/pkg.import.xml')
+    xpackage.InsertEndChild(ximport)
+    xcontents.InsertEndChild(xpackage)
+    doc.InsertEndChild(xcontents)
+    assert doc.SaveFile()
+
+    doc = core.TiXmlDocument(str(install.join('pkg', 'pkg.import.xml')))
+    xpackage = core.TiXmlElement('package')
+    xpackage.SetAttribute('name', 'pkg')
+    doc.InsertEndChild(xpackage)
+    assert doc.SaveFile()
+
+    return install
+
+
+def make_data(n):
+    """Returns the contents of the nth version of the package archive.
+    Successive versions differ in a few places, so that patches between
+    them are much smaller than the archive."""
+    rand = random.Random(1234)
+    data = bytearray(rand.getrandbits(8) for i in range(65536))
+    for i in range(n):
+        data[i * 4000:i * 4000 + 100] = bytearray([i + 1]) * 100
+    return bytes(data)
+
+
+def publish(install, data):
+    """Writes data as the new current version of the package, the way that
+    ppackage does: a new compressed archive, and a new desc file that carries
+    over the patch entries of the old one.  Returns the archive's hash."""
+    pkg = install.join('pkg')
+    package_dir = make_filename(pkg)
+
+    seq = SeqValue()
+    patch_version = None
+    xcarried = []
+    doc = core.TiXmlDocument(str(pkg.join('pkg.xml')))
+    if doc.LoadFile():
+        xpackage = doc.FirstChildElement('package')
+        seq.loadXml(xpackage)
+        patch_version = xpackage.Attribute('patch_version') or \
+                        xpackage.Attribute('last_patch_version')
+        for xchild in iterChildElements(xpackage):
+            if xchild.Value() in ('base_version', 'top_version', 'patch'):
+                xcarried.append(xchild.Clone())
+    seq += 1
+
+    pkg.join('pkg.mf').write(data, mode='wb')
+    assert core.compress_file(core.Filename(package_dir, 'pkg.mf'),
+                              core.Filename(package_dir, 'pkg.mf.pz'), 6)
+
+    doc = core.TiXmlDocument(str(pkg.join('pkg.xml')))
+    xpackage = core.TiXmlElement('package')
+    xpackage.SetAttribute('name', 'pkg')
+    xpackage.SetAttribute('platform', 'linux')
+    xpackage.SetAttribute('version', '1.0')
+    if patch_version:
+        xpackage.SetAttribute('last_patch_version', patch_version)
+    seq.storeXml(xpackage)
+
+    archive = FileSpec()
+    archive.fromFile(package_dir, 'pkg.mf')
+    xarchive = core.TiXmlElement('uncompressed_archive')
+    archive.storeXml(xarchive)
+    xpackage.InsertEndChild(xarchive)
+
+    compressed = FileSpec()
+    compressed.fromFile(package_dir, 'pkg.mf.pz')
+    xcompressed = core.TiXmlElement('compressed_archive')
+    compressed.storeXml(xcompressed)
+    xpackage.InsertEndChild(xcompressed)
+
+    for xchild in xcarried:
+        xpackage.InsertEndChild(xchild)
+
+    doc.InsertEndChild(xpackage)
+    assert doc.SaveFile()
+
+    # ppackage doesn't keep the uncompressed archive around.
+    pkg.join('pkg.mf').remove()
+    return archive.hash
+
+
+def read_package(install):
+    """Returns the package as recorded in its desc file."""
+    pm = PatchMaker(make_filename(install))
+    package = pm.readPackageDescFile(core.Filename('pkg/pkg.xml'))
+    assert package
+    return package
+
+
+@requires_xml
+def test_write_contents_file(install):
+    v1 = publish(install, make_data(1))
+    assert PatchMaker(make_filename(install)).buildPatches()
+
+    # The first version becomes the base and top, with no patches yet.
+    package = read_package(install)
+    assert package.patchVersion == 1
+    assert package.baseFile.hash == v1
+    assert package.topFile.hash == v1
+    assert package.patches == []
+    assert install.join('pkg', 'pkg.mf.1.pz').exists()
+    assert install.join('pkg', 'pkg.mf.base.pz').exists()
+
+    # contents.xml must describe the desc files as they are now on disk.
+    doc = core.TiXmlDocument(str(install.join('contents.xml')))
+    assert doc.LoadFile()
+    xcontents = doc.FirstChildElement('contents')
+    assert xcontents.Attribute('seq') == '2'
+    xpackage = xcontents.FirstChildElement('package')
+    assert xpackage.Attribute('seq') == '2'
+
+    desc = FileSpec()
+    desc.fromFile(make_filename(install), 'pkg/pkg.xml')
+    assert xpackage.Attribute('hash') == desc.hash
+
+    import_desc = FileSpec()
+    import_desc.fromFile(make_filename(install), 'pkg/pkg.import.xml')
+    assert xpackage.FirstChildElement('import').Attribute('hash') == import_desc.hash
+
+    # The import desc file gets the same seq as the desc file.
+    doc = core.TiXmlDocument(str(install.join('pkg', 'pkg.import.xml')))
+    assert doc.LoadFile()
+    assert doc.FirstChildElement('package').Attribute('seq') == '2'
+
+
+@requires_xml
+def test_reuse_patch(install):
+    # Build patches from version 1 to 2, and back to 1 again.
+    v1 = publish(install, make_data(1))
+    assert PatchMaker(make_filename(install)).buildPatches()
+    v2 = publish(install, make_data(2))
+    assert PatchMaker(make_filename(install)).buildPatches()
+    publish(install, make_data(1))
+    assert PatchMaker(make_filename(install)).buildPatches()
+
+    package = read_package(install)
+    patches = [(patchfile.sourceFile.hash, patchfile.targetFile.hash)
+               for patchfile in package.patches]
+    assert patches == [(v1, v2), (v2, v1)]
+    assert package.topFile.hash == v1
+
+    # Going forward to version 2 again needs no new patch; the one we
+    # already have becomes the top of the chain.
+    publish(install, make_data(2))
+    assert PatchMaker(make_filename(install)).buildPatches()
+
+    package = read_package(install)
+    patches = [(patchfile.sourceFile.hash, patchfile.targetFile.hash)
+               for patchfile in package.patches]
+    assert patches == [(v1, v2), (v2, v1)]
+    assert package.topFile.hash == v2
+    assert package.baseFile.hash == v1
+    assert not install.join('pkg', 'pkg.mf.4.patch.pz').exists()
+
+
+def test_prune_patches():
+    pm, package = make_graph([('a', 'b'), ('b', 'c'), ('c', 'd'), ('d', 'b')])
+
+    # Every patch here can still lead to b, by way of d.
+    package.currentPv = get_pv(pm, 'b')
+    pm.prunePatches(package)
+    assert patch_names(package.patches) == ['a_b.patch', 'b_c.patch', 'c_d.patch', 'd_b.patch']
+
+    pm, package = make_graph([('a', 'b'), ('b', 'c'), ('c', 'd')])
+
+    # Only the patch to b can lead to b; the others are dropped.
+    package.currentPv = get_pv(pm, 'b')
+    pm.prunePatches(package)
+    assert patch_names(package.patches) == ['a_b.patch']
+    assert list(pm.patchFilenames.keys()) == ['a_b.patch']
+    assert get_pv(pm, 'b').toPatches == []
+    assert get_pv(pm, 'c').fromPatches == []
+    assert get_pv(pm, 'c').toPatches == []
+    assert get_pv(pm, 'd').fromPatches == []
+
+
+@requires_xml
+def test_rebase_large_archive(install):
+    v1 = publish(install, make_data(1))
+    assert PatchMaker(make_filename(install)).buildPatches()
+    publish(install, make_data(2))
+    assert PatchMaker(make_filename(install)).buildPatches()
+    assert len(read_package(install).patches) == 1
+
+    # Version 3 is too large to patch, so it becomes the new base, and the
+    # patch to version 2 is dropped, since it can't lead there any more.
+    v3 = publish(install, make_data(3))
+    pm = PatchMaker(make_filename(install), maxPatchArchiveSize = 1)
+    assert pm.buildPatches()
+
+    package = read_package(install)
+    assert package.baseFile.hash == v3
+    assert package.topFile.hash == v3
+    assert package.patches == []
+
+    base = FileSpec()
+    base.fromFile(make_filename(install), 'pkg/pkg.mf.base.pz')
+    compressed = FileSpec()
+    compressed.fromFile(make_filename(install), 'pkg/pkg.mf.3.pz')
+    assert base.hash == compressed.hash
+
+    # Later versions are patched from the new base as usual.
+    v4 = publish(install, make_data(4))
+    assert PatchMaker(make_filename(install)).buildPatches()
+
+    package = read_package(install)
+    patches = [(patchfile.sourceFile.hash, patchfile.targetFile.hash)
+               for patchfile in package.patches]
+    assert patches == [(v3, v4)]
+
+
+@requires_xml
+def test_rebase_large_patch(install):
+    publish(install, make_data(1))
+    assert PatchMaker(make_filename(install)).buildPatches()
+    v2 = publish(install, make_data(2))
+
+    pm = PatchMaker(make_filename(install))
+    assert pm.readContentsFile()
+    pm.buildPatchChains()
+    package, = pm.packages
+
+    # Pretend that we built a patch that is larger than the archive itself.
+    size = package.compressedPathname.getFileSize()
+    pathname = core.Filename(package.packageDir, package.patchFilename + '.pz')
+    install.join('pkg', pathname.getBasename()).write(b'x' * (size + 1), mode='wb')
+
+    pm.addPatchfile(package.topPv, package.currentPv, package, package.patchFilename)
+    assert not pathname.exists()
+    assert package.patches == []
+    assert package.basePv is package.currentPv
+    assert package.topPv is package.currentPv
+
+    pm.writeContentsFile()
+    pm.cleanup()
+
+    package = read_package(install)
+    assert package.baseFile.hash == v2
+    assert package.topFile.hash == v2
+    assert package.patches == []